@@ -1,12 +1,19 @@
+import argparse
 import bz2
-import json
+import functools
+import hashlib
 import logging
 import shutil
 import sqlite3
+import threading
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import groupby
 from pathlib import Path
 
+import orjson
 import requests
-from bs4 import BeautifulSoup
+from lxml import html as lxml_html
 from vectara.factory import Factory
 
 tafsirs = {
@@ -15,15 +22,16 @@ tafsirs = {
 }
 
 CORPUS_KEY = "tafsirs"
+# Default number of surah documents uploaded to Vectara concurrently
+UPLOAD_WORKERS = 8
 DOWNLOADS_DIR = Path("./downloads").absolute()
 
-# Initialize the client
+# Tags split out of the tafsir HTML
+SPLIT_TAGS = ("h1", "h2", "p")
+
 lg = logging.getLogger("import_tafsir")
 lg.setLevel(logging.INFO)
 
-client = Factory(profile="lab").build()
-manager = client.corpus_manager
-
 # A note on "Ayah ints": Ayah ints are the integer representation of the ayah key.
 # It is the same as the surah number multiplied by 1000 and added to the ayah number.
 # For example, ayah 1 of surah 1 has an ayah int of 1001, and ayah 2 of surah 1 has an ayah int of 1002.
@@ -31,18 +39,38 @@ manager = client.corpus_manager
 # For example, if you want to get all ayahs between ayah 1 of surah 1 and ayah 2 of surah 2,
 # you can use the range (1001, 2002).
 
+# SQL expression for the ayah int of a tafsir row. Queries must use it verbatim for
+# SQLite to pick up the index on it.
+AYAH_INT_SQL = (
+    "CAST(substr(ayah_key, 1, instr(ayah_key, ':') - 1) AS INTEGER) * 1000"
+    " + CAST(substr(ayah_key, instr(ayah_key, ':') + 1) AS INTEGER)"
+)
+AYAH_INT_INDEX_SQL = (
+    f"CREATE INDEX IF NOT EXISTS tafsir_ayah_int ON tafsir ({AYAH_INT_SQL});"
+)
+# Rows with text in a [start, end) range of ayah ints, in ayah order
+AYAH_RANGE_SQL = f"""
+SELECT ayah_key, group_ayah_key, from_ayah, to_ayah, ayah_keys, text
+FROM tafsir
+WHERE {AYAH_INT_SQL} >= ? AND {AYAH_INT_SQL} < ? AND text != ''
+ORDER BY {AYAH_INT_SQL};
+"""
+
 
+@functools.lru_cache(maxsize=8192)
 def ayah_key_to_int(ayah_key: str) -> int:
     """
     Get the ayah int from the ayah key.
 
+    Results are cached, as the same keys are converted for every document part.
+
     Args:
         ayah_key (str): The ayah key to convert.
 
     Returns:
         int: The ayah int.
     """
-    surah, ayah = ayah_key.split(":")
+    surah, ayah = ayah_key.split(":", 1)
     return int(surah) * 1000 + int(ayah)
 
 
@@ -61,22 +89,29 @@ def ayah_int_to_key(ayah_int: int) -> str:
     return f"{surah}:{ayah}"
 
 
-def split_html_by_tags(html):
+@functools.cache
+def get_client():
     """
-    Split HTML content into individual <h1> and <p> elements.
+    Get the Vectara client, building it on first use.
+
+    Returns:
+        The Vectara client for the "lab" profile.
+    """
+    return Factory(profile="lab").build()
+
+
+def split_html_by_tags(html: str) -> Iterator[str]:
+    """
+    Split HTML content into individual <h1>, <h2> and <p> elements.
 
     Args:
         html (str): The HTML content to split.
 
     Returns:
-        list: A list of split elements containing <h1> and <p> tags.
+        Iterator[str]: The text of each split element, extracted lazily.
     """
-    soup = BeautifulSoup(html, "html.parser")
-    split_elements = []
-    for element in soup.find_all(["h1", "h2", "p"]):
-        split_elements.append(str(element.get_text()))
-    lg.info(f"Split elements: {split_elements}")
-    return split_elements
+    root = lxml_html.fragment_fromstring(html, create_parent="div")
+    return (element.text_content() for element in root.iter(*SPLIT_TAGS))
 
 
 def download_tafsir(tafsir_name: str) -> None:
@@ -101,21 +136,37 @@ def download_tafsir(tafsir_name: str) -> None:
     # Download the tafsir file from the provided URL
     url = tafsirs.get(tafsir_name)
     if url:
-        response = requests.get(url, stream=True)
-        compressed_file_path = DOWNLOADS_DIR / f"{tafsir_name}.sqlite.bz2"
-        # Save the downloaded compressed file
-        with open(compressed_file_path, "wb") as f:
-            shutil.copyfileobj(response.raw, f)
-        lg.info(f"{compressed_file_path} downloaded")
+        # Decompress the response while it streams in. Write to a partial file that is
+        # only moved into place once complete, so an interrupted download is not
+        # mistaken for a finished one.
+        part_file_path = DOWNLOADS_DIR / f"{tafsir_name}.sqlite.part"
+        with requests.get(url, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            with bz2.open(response.raw, "rb") as src, open(part_file_path, "wb") as dst:
+                shutil.copyfileobj(src, dst, length=1024 * 1024)
+        part_file_path.replace(file_path)
+        lg.info(f"{url} downloaded and decompressed to {file_path}")
+
+
+def connect_tafsir_db(tafsir_name: str) -> sqlite3.Connection:
+    """
+    Connect to a downloaded tafsir sqlite file, tuned for bulk reads.
 
-        # Decompress data from file
-        with bz2.open(compressed_file_path, "rb") as f:
-            content = f.read()
+    Args:
+        tafsir_name (str): The name of the tafsir to connect to.
 
-        # Write decompressed data to file
-        with open(file_path, "wb") as f:
-            f.write(content)
-        lg.info(f"{compressed_file_path} decompressed to {file_path}")
+    Returns:
+        sqlite3.Connection: The database connection.
+    """
+    conn = sqlite3.connect(DOWNLOADS_DIR / f"{tafsir_name}.sqlite")
+    # Use a large page cache, read pages through mmap instead of read() copies and
+    # keep temporary sort data in memory. mmap_size is only an upper bound, so the
+    # whole file is mapped for even the largest tafsirs.
+    conn.execute("PRAGMA cache_size = -262144")  # 256 MiB
+    conn.execute("PRAGMA mmap_size = 1073741824")  # 1 GiB
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
 
 
 def generate_ayah_mapping(tafsir_name: str) -> None:
@@ -125,118 +176,301 @@ def generate_ayah_mapping(tafsir_name: str) -> None:
     Args:
         tafsir_name (str): The name of the tafsir to generate mapping for.
     """
-    db_path = DOWNLOADS_DIR / f"{tafsir_name}.sqlite"
-
     # Use a context manager to connect to the sqlite database
-    with sqlite3.connect(db_path) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT ayah_key, group_ayah_key FROM tafsir;")
-        ayah_raw = cursor.fetchall()
-        ayah_mapping = {ayah[0]: ayah[1] for ayah in ayah_raw}
+    with connect_tafsir_db(tafsir_name) as conn:
+        # dict() consumes the (ayah_key, group_ayah_key) rows straight from the cursor
+        ayah_mapping = dict(
+            conn.execute("SELECT ayah_key, group_ayah_key FROM tafsir;")
+        )
 
     # Save the mapping to a JSON file
     mapping_file_path = DOWNLOADS_DIR / f"{tafsir_name}-ayah-mapping.json"
-    with open(mapping_file_path, "w", encoding="utf-8") as json_file:
-        json.dump(ayah_mapping, json_file, indent=4, ensure_ascii=False)
+    with open(mapping_file_path, "wb") as json_file:
+        json_file.write(orjson.dumps(ayah_mapping, option=orjson.OPT_INDENT_2))
     lg.info(f"Ayah mapping for {tafsir_name} saved to {mapping_file_path}")
 
 
-def convert_to_vectara(tafsir_name: str, surah_range: tuple[int, int] = (1, 2)) -> None:
+def upload_document(core_doc: dict) -> None:
+    """
+    Replace a core document in Vectara, deleting any previous version first.
+
+    Args:
+        core_doc (dict): The core document to upload.
+    """
+    document_id = core_doc["id"]
+
+    # Delete the document if it already exists
+    lg.info(f"Deleting {document_id} from Vectara")
+    try:
+        get_client().documents.delete(corpus_key=CORPUS_KEY, document_id=document_id)
+    except Exception as e:
+        lg.info("Could not delete document: " + str(e))
+    # Upload the document to Vectara
+    lg.info(f"Uploading {document_id} to Vectara")
+    get_client().documents.create(
+        corpus_key=CORPUS_KEY,
+        request=core_doc,
+        request_timeout=900,
+        request_options={"timeout": 900},
+    )
+
+
+def upload_surah_document(core_doc: dict, digest_file_path: Path, digest: str) -> None:
+    """
+    Upload a core document and record its digest once the upload has succeeded.
+
+    Args:
+        core_doc (dict): The core document to upload.
+        digest_file_path (Path): The file to record the digest in.
+        digest (str): The SHA-256 hex digest of the serialized document.
+    """
+    upload_document(core_doc)
+    digest_file_path.write_text(digest)
+
+
+def convert_to_vectara(
+    tafsir_name: str,
+    surah_range: tuple[int, int] = (1, 2),
+    workers: int = UPLOAD_WORKERS,
+    force: bool = False,
+) -> None:
     """
-    Convert tafsir sqlite file to vectara format.
+    Convert tafsir sqlite file to vectara format and upload it.
+
+    Surah documents are built sequentially and uploaded by a pool of threads,
+    so network round trips overlap with parsing. At most twice as many documents
+    as there are workers are queued or uploading at once. The SHA-256 of each
+    uploaded document is stored next to its JSON file, and surahs whose document
+    has not changed since their last successful upload are skipped.
 
     Args:
         tafsir_name (str): The name of the tafsir to convert.
         surah_range (tuple): The range of surahs to convert (start, end).
+        workers (int): The number of documents to upload concurrently.
+        force (bool): Upload every surah, even if its document is unchanged.
     """
-    db_path = DOWNLOADS_DIR / f"{tafsir_name}.sqlite"
+    # Build the client before the upload threads start sharing it
+    get_client()
+
+    uploads = {}
+    # Parsing outpaces uploading, so limit the documents waiting in the executor's
+    # otherwise unbounded queue
+    upload_slots = threading.BoundedSemaphore(2 * workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            # Use a context manager to connect to the sqlite database
+            with connect_tafsir_db(tafsir_name) as conn:
+                cursor = conn.cursor()
+
+                # Index the ayah ints once, turning the surah range into a B-tree range
+                # scan that is already in order
+                cursor.execute(AYAH_INT_INDEX_SQL)
+
+                # Fetch all ayahs in the surah range in one ordered scan, filtering out
+                # empty text fields
+                start, end = surah_range
+                cursor.execute(AYAH_RANGE_SQL, (start * 1000, end * 1000))
+
+                # Rows are streamed from the cursor and grouped by surah as they arrive
+                next_surah = start
+                for surah, ayahs in groupby(
+                    cursor, key=lambda ayah: ayah_key_to_int(ayah[0]) // 1000
+                ):
+                    # Surahs without any rows with text are never grouped
+                    for missing in range(next_surah, surah):
+                        lg.info(f"No parts extracted for surah {missing}")
+                    next_surah = surah + 1
+                    surah_id = f"{surah:0>3}"
+                    v_ayahs = []
+                    core_doc = {
+                        "type": "core",
+                        "id": f"{tafsir_name}-{surah_id}",
+                        "metadata": {"tafsir": tafsir_name, "surah": surah_id},
+                        "document_parts": v_ayahs,
+                    }
+
+                    for (
+                        ayah_key,
+                        group_ayah_key,
+                        from_ayah,
+                        to_ayah,
+                        ayah_keys,
+                        text,
+                    ) in ayahs:
+                        lg.debug("Processing ayah: %s", ayah_key)
+                        # All parts of an ayah share the same metadata dict
+                        metadata = {
+                            "ayah_key": ayah_key,
+                            "group_ayah_key": group_ayah_key,
+                            "from_ayah": from_ayah,
+                            "to_ayah": to_ayah,
+                            "from_ayah_int": ayah_key_to_int(from_ayah),
+                            "to_ayah_int": ayah_key_to_int(to_ayah),
+                            "ayah_keys": ayah_keys,
+                        }
+                        # Add document parts for each tag extracted from the ayah text
+                        v_ayahs.extend(
+                            {"metadata": metadata, "text": part}
+                            for part in split_html_by_tags(text)
+                            if part
+                        )
 
-    # Use a context manager to connect to the sqlite database
-    with sqlite3.connect(db_path) as conn:
-        cursor = conn.cursor()
-
-        for surah in range(*surah_range):
-            # Fetch all ayahs for the current surah, filtering out empty text fields
-            cursor.execute(
-                """
-                SELECT ayah_key, group_ayah_key, from_ayah, to_ayah, ayah_keys, text 
-                FROM tafsir 
-                WHERE ayah_key LIKE ?;
-                """,
-                (f"{surah}:%",),
-            )
-            ayahs = cursor.fetchall()
-            v_ayahs = []
-            core_doc = {
-                "type": "core",
-                "id": f"{tafsir_name}-{surah:0>3}",
-                "metadata": {"tafsir": tafsir_name, "surah": f"{surah:0>3}"},
-                "document_parts": v_ayahs,
-            }
-
-            for ayah in ayahs:
-                lg.info("Processing ayah: " + ayah[0])
-                parts = split_html_by_tags(ayah[5])
-                # Add document parts for each tag extracted from the ayah text
-                for part in parts:
-                    if part:
-                        v_ayahs.append(
-                            {
-                                "metadata": {
-                                    "ayah_key": ayah[0],
-                                    "group_ayah_key": ayah[1],
-                                    "from_ayah": ayah[2],
-                                    "to_ayah": ayah[3],
-                                    "from_ayah_int": ayah_key_to_int(ayah[2]),
-                                    "to_ayah_int": ayah_key_to_int(ayah[3]),
-                                    "ayah_keys": ayah[4],
-                                },
-                                "text": part,
-                            }
+                    # Log total number of parts extracted
+                    lg.info(f"Total parts: {len(v_ayahs)}")
+                    if len(v_ayahs) != 0:
+                        json_file_path = DOWNLOADS_DIR / f"{tafsir_name}-{surah}.json"
+                        digest_file_path = json_file_path.with_name(
+                            f"{json_file_path.name}.sha256"
                         )
+                        body = orjson.dumps(core_doc)
+                        digest = hashlib.sha256(body).hexdigest()
+
+                        # Skip surahs whose document matches the last successful upload
+                        if (
+                            not force
+                            and digest_file_path.exists()
+                            and digest_file_path.read_text() == digest
+                        ):
+                            lg.info(f"Surah {surah} is unchanged, skipping upload")
+                            continue
+
+                        # Save core document to a compact JSON file, as it is only read
+                        # back by machines
+                        with open(json_file_path, "wb") as json_file:
+                            json_file.write(body)
+
+                        # The old digest no longer describes what is in Vectara once the
+                        # delete-then-create starts
+                        digest_file_path.unlink(missing_ok=True)
+                        upload_slots.acquire()
+                        future = executor.submit(
+                            upload_surah_document, core_doc, digest_file_path, digest
+                        )
+                        future.add_done_callback(lambda _: upload_slots.release())
+                        uploads[future] = surah
+                    else:
+                        lg.info(f"No parts extracted for surah {surah}")
 
-            # Log total number of parts extracted
-            lg.info(f"Total parts: {len(v_ayahs)}")
-            if len(v_ayahs) != 0:
-                # Save core document to JSON file
-                json_file_path = DOWNLOADS_DIR / f"{tafsir_name}-{surah}.json"
-                with open(json_file_path, "w", encoding="utf-8") as json_file:
-                    json.dump(core_doc, json_file, indent=4, ensure_ascii=False)
+                for missing in range(next_surah, end):
+                    lg.info(f"No parts extracted for surah {missing}")
 
-                # Delete the document if it already exists
-                lg.info(f"Deleting surah {surah} from Vectara")
+            # Wait for the uploads, collecting failures instead of stopping at the first
+            failed = []
+            for future in as_completed(uploads):
                 try:
-                    client.documents.delete(
-                        corpus_key=CORPUS_KEY, document_id=f"{tafsir_name}-{surah}"
-                    )
+                    future.result()
                 except Exception as e:
-                    lg.info("Could not delete document: " + str(e))
-                # Upload the document to Vectara
-                lg.info(f"Uploading surah {surah} to Vectara")
-                client.documents.create(
-                    corpus_key=CORPUS_KEY,
-                    request=core_doc,
-                    request_timeout=900,
-                    request_options={"timeout": 900},
-                )
-            else:
-                lg.info(f"No parts extracted for surah {surah}")
-
-
-# Example usage
-download_tafsir("ibn-kathir")
-generate_ayah_mapping("ibn-kathir")
-convert_to_vectara("ibn-kathir", surah_range=(114, 115))
-
-# Make a test query to check if the document was uploaded successfully
-response = client.corpora.query(
-    CORPUS_KEY,
-    query="What is the significance of comparing women to coral?",
-    # Filter the query to only search ayah 55:58 --> 55058 as an ayah_int
-    search={
-        "limit": 100,
-        "metadata_filter": "part.to_ayah_int >= 55058 and part.from_ayah_int <= 55058",
-    },
-)
+                    lg.error(f"Could not upload surah {uploads[future]}: {e}")
+                    failed.append(uploads[future])
+        except BaseException:
+            # Drop the queued uploads so errors and Ctrl-C surface once the uploads
+            # already running finish, rather than after every queued one
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+
+    if failed:
+        raise RuntimeError(f"Failed to upload surahs {sorted(failed)} of {tafsir_name}")
+
+
+def ayah_int_arg(value: str) -> int:
+    """
+    Parse an ayah key command line argument into an ayah int.
+
+    Args:
+        value (str): The ayah key to parse, e.g. "55:58".
+
+    Returns:
+        int: The ayah int.
+    """
+    try:
+        return ayah_key_to_int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"invalid ayah key {value!r}, expected SURAH:AYAH such as 55:58"
+        )
+
+
+def positive_int_arg(value: str) -> int:
+    """
+    Parse a positive integer command line argument.
+
+    Args:
+        value (str): The integer to parse.
+
+    Returns:
+        int: The parsed integer, at least 1.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive integer, got {value!r}")
+    return number
+
+
+def main() -> None:
+    """
+    Download a tafsir, generate its ayah mapping and upload it to Vectara.
+    """
+    parser = argparse.ArgumentParser(description="Index a QUL tafsir into Vectara.")
+    parser.add_argument("tafsir", choices=sorted(tafsirs), help="The tafsir to index.")
+    parser.add_argument(
+        "--surah-range",
+        nargs=2,
+        type=int,
+        default=(1, 115),
+        metavar=("START", "END"),
+        help="The range of surahs to convert, end exclusive (default: all surahs).",
+    )
+    parser.add_argument(
+        "--workers",
+        type=positive_int_arg,
+        default=UPLOAD_WORKERS,
+        help="The number of documents to upload concurrently (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Upload every surah, even those unchanged since their last upload.",
+    )
+    parser.add_argument(
+        "--query", help="A test query to run once the upload has finished."
+    )
+    parser.add_argument(
+        "--ayah",
+        type=ayah_int_arg,
+        help="Only search parts covering this ayah key, e.g. 55:58.",
+    )
+    args = parser.parse_args()
+    if args.ayah is not None and not args.query:
+        parser.error("--ayah can only be used together with --query")
+
+    logging.basicConfig()
+
+    download_tafsir(args.tafsir)
+    generate_ayah_mapping(args.tafsir)
+    convert_to_vectara(
+        args.tafsir,
+        surah_range=tuple(args.surah_range),
+        workers=args.workers,
+        force=args.force,
+    )
+
+    # Make a test query to check if the document was uploaded successfully
+    if args.query:
+        search = {"limit": 100}
+        if args.ayah is not None:
+            # Filter the query to parts whose ayah range covers the ayah int
+            ayah_int = args.ayah
+            search["metadata_filter"] = (
+                f"part.to_ayah_int >= {ayah_int} and part.from_ayah_int <= {ayah_int}"
+            )
+        response = get_client().corpora.query(
+            CORPUS_KEY, query=args.query, search=search
+        )
+        lg.info(f"Result: {response}")
+
 
-lg.info(f"Result: {response}")
+if __name__ == "__main__":
+    main()